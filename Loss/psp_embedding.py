@@ -29,13 +29,13 @@ def embedding_loss(z_id_X, z_id_Y,tags=None):
 
 
 class Psp_Embedding(nn.Module):
-    def __init__(self,psp_encoder_path,start_latent=None,n_psp_latent=None,all_psp_latent=14):
+    def __init__(self,psp_encoder_path,start_latent=None,n_psp_latent=None,all_psp_latent=14,psp_ckpt=None):
         super(Psp_Embedding, self).__init__()
         print('Loading ResNet ArcFace')
 
         self.psp_encoder = None
         if psp_encoder_path is not None:
-            self.psp_encoder = self.get_psp_encoder(psp_encoder_path=psp_encoder_path).eval().cuda()
+            self.psp_encoder = self.get_psp_encoder(psp_encoder_path=psp_encoder_path,ckpt=psp_ckpt).eval().cuda()
         if start_latent == None: self.start_latent = 0
         else:  self.start_latent = start_latent
         if n_psp_latent == None: self.n_psp_latent = self.psp_opts.n_styles
@@ -106,9 +106,10 @@ class Psp_Embedding(nn.Module):
 
         return codes
 
-    def get_psp_encoder(self, psp_encoder_path):
+    def get_psp_encoder(self, psp_encoder_path, ckpt=None):
         # update test options with options used during training
-        ckpt = torch.load(psp_encoder_path, map_location='cpu')
+        if ckpt is None:
+            ckpt = torch.load(psp_encoder_path, map_location='cpu')
         self.psp_opts = ckpt['opts']
         self.psp_opts['n_styles'] = 18
         self.psp_opts = Namespace(**self.psp_opts)
@@ -5,6 +5,7 @@ import sys
 # print(sys.path)
 #guided facial image recovery
 import argparse
+import functools
 import math
 import random
 import os
@@ -15,7 +16,7 @@ from tqdm import tqdm
 from op.utils import mkdirs,delete_dirs,set_random_seed
 
 from img_load_util import *
-from test import get_model
+from models.exe_gan_model import EXE_GAN
 try:
     import wandb
 
@@ -144,6 +145,97 @@ def get_mix_latent(infer_img,psp_embedding,lambda_=None):
 
 
 
+@functools.cache
+def _load_psp(path):
+    """torch.load the pSp checkpoint once per absolute path string.
+
+    Long-running processes can free the cached dict with _load_psp.cache_clear().
+    """
+    return torch.load(path, map_location='cpu')
+
+
+@functools.cache
+def _load_exegan(path):
+    """torch.load the EXE-GAN checkpoint once per absolute path string.
+
+    Long-running processes can free the cached dict with _load_exegan.cache_clear().
+    """
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+def build_model(psp_ckpt_path, exegan_ckpt_path, size=256, compile_model=True):
+    """
+    Build a fresh EXE-GAN model from cached checkpoints.
+
+    The checkpoints are deserialized at most once per process (see _load_psp /
+    _load_exegan), so reinstantiating callers (hot reload, tests, multiple
+    workers in one process) skip the disk read and pickle cost.
+
+    :param psp_ckpt_path: path string to the pSp checkpoint
+    :param exegan_ckpt_path: path string to the EXE-GAN checkpoint
+    :param size:  size : 256 ..
+    :param compile_model: specialize the generator with torch.compile for the
+                          fixed input shape. Compilation is lazy: Inductor
+                          errors surface at the first forward, so callers
+                          that want an eager fallback must handle it there
+                          (the service warmup does).
+    :return: an EXE_GAN model, already in eval mode on GPU
+    """
+    print("model name: exe_gan !!!!!!!!!!!!!!!")
+    model = EXE_GAN(
+        exe_ckpt_path=exegan_ckpt_path,
+        psp_ckpt_path=psp_ckpt_path,
+        size=size,
+        exe_ckpt=_load_exegan(os.path.abspath(exegan_ckpt_path)),
+        psp_ckpt=_load_psp(os.path.abspath(psp_ckpt_path)),
+    )
+    if compile_model and hasattr(torch, "compile"):
+        model.generator = torch.compile(model.generator, mode="reduce-overhead")
+    return model
+
+
+def _autocast_dtype():
+    """bfloat16 where the GPU supports it (Ampere and newer), float16 otherwise."""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+def run_inference(model, gt_tensor, mask_tensor, exemplar_tensor, sample_times=1, use_amp=True):
+    """
+    Run guided recovery on already-loaded tensors.
+
+    :param model: EXE_GAN model from build_model
+    :param gt_tensor: [b,3,size,size] image tensor in [-1,1]
+    :param mask_tensor: [b,1,size,size] mask tensor, masked pixel = 1
+    :param exemplar_tensor: [b,3,size,size] exemplar tensor in [-1,1]
+    :param sample_times: number of stochastic samples per input
+    :param use_amp: run the forward pass under torch.autocast (bf16/fp16);
+                    GAN inference is robust to reduced precision and tensor
+                    cores roughly double the throughput
+    :return: list (length = sample_times) of completed image tensors in [-1,1]
+    """
+    completed_imgs = []
+    # inference_mode also skips version-counter and view tracking, which
+    # no_grad keeps paying for
+    with torch.inference_mode():
+        with torch.autocast(device_type="cuda", dtype=_autocast_dtype(), enabled=use_amp):
+            # The exemplar embedding and mean latent are identical for every
+            # sample; compute them once instead of per iteration.
+            infer_embeddings = model.psp_embedding(exemplar_tensor)
+            truncation_latent = model.generator.mean_latent(4096, device=model.device)
+            for _ in range(sample_times):
+                completed_img, _, _, _ = model.get_inherent_stoc(
+                    gt_tensor,
+                    mask_tensor,
+                    infer_imgs=exemplar_tensor,
+                    infer_embeddings=infer_embeddings,
+                    truncation_latent=truncation_latent,
+                )
+                completed_imgs.append(completed_img)
+    return completed_imgs
+
+
 def get_name_fromTime():
     import time
     time.sleep(1)
@@ -187,7 +279,7 @@ if __name__ == "__main__":
     exe_imgs = get_img_lists(args.exemplar_dir, exe_post)
 
 
-    generator = get_model(args, model_path=args.ckpt, psp_path=args.psp_checkpoint_path)
+    generator = build_model(args.psp_checkpoint_path, args.ckpt, size=args.size)
 
     for i in tqdm(range(len(exe_imgs))):
         exe_img_ = load_img2tensor(exe_imgs[i],args.size).to(device)
@@ -197,8 +289,8 @@ if __name__ == "__main__":
         ##get mask
         mask_01 = mask_
         name = str(os.path.basename(exe_imgs[i])).split("_")[0]
-        for jj in range(args.sample_times):
-            completed_img, _, infer_imgs,_ = generator.get_inherent_stoc(gt_img_, mask_01,infer_imgs=exe_img_)
+        completed_imgs = run_inference(generator, gt_img_, mask_01, exe_img_, sample_times=args.sample_times)
+        for jj, completed_img in enumerate(completed_imgs):
 
             utils.save_image(
                 completed_img.add(1).mul(0.5),
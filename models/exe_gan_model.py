@@ -9,10 +9,13 @@ from train import  mixing_noise
 class EXE_GAN():
 
     def __init__(self,exe_ckpt_path,psp_ckpt_path,
-                 latent = 512,n_mlp = 8,size = 256,channel_multiplier = 2,psp_start_latent=4,num_psp_latent=10,mixing=0.5,device="cuda"):
+                 latent = 512,n_mlp = 8,size = 256,channel_multiplier = 2,psp_start_latent=4,num_psp_latent=10,mixing=0.5,device="cuda",
+                 exe_ckpt=None,psp_ckpt=None):
         """
         :param exe_ckpt_path: EXE GAN checkpoint path
         :param psp_ckpt_path: pSp checkpoint path
+        :param exe_ckpt: optional already-loaded EXE GAN checkpoint dict (skips torch.load)
+        :param psp_ckpt: optional already-loaded pSp checkpoint dict (skips torch.load)
 
         #### parameters shonw below don't need change
         :param latent:  latent size
@@ -38,12 +41,13 @@ class EXE_GAN():
         ##init embedding
         print("start_latent :%d" % psp_start_latent)
         print("n_psp_latent :%d" % num_psp_latent)
-        self.psp_embedding = Psp_Embedding(psp_ckpt_path, psp_start_latent, num_psp_latent).to(device)
+        self.psp_embedding = Psp_Embedding(psp_ckpt_path, psp_start_latent, num_psp_latent, psp_ckpt=psp_ckpt).to(device)
 
         print("load models:", exe_ckpt_path)
-        ckpt = torch.load(exe_ckpt_path, map_location=lambda storage, loc: storage)
+        if exe_ckpt is None:
+            exe_ckpt = torch.load(exe_ckpt_path, map_location=lambda storage, loc: storage)
 
-        self.generator.load_state_dict(ckpt["g_ema"])
+        self.generator.load_state_dict(exe_ckpt["g_ema"])
 
         self.psp_embedding.eval()
         self.generator.eval()
@@ -80,11 +84,13 @@ class EXE_GAN():
         return embedding_score
 
 
-    def get_inherent_stoc(self,real_imgs,mask_01,infer_imgs=None,truncation=1):
+    def get_inherent_stoc(self,real_imgs,mask_01,infer_imgs=None,truncation=1,infer_embeddings=None,truncation_latent=None):
         """
                 :param real_imgs: with size [b,c,h,w]
                 :param mask_01: with size [b,1,h,w]    masked pixel = 1, others = 0
                 :param infer_imgs:  with size [b,c,h,w] or None
+                :param infer_embeddings: optional precomputed pSp embedding of infer_imgs
+                :param truncation_latent: optional precomputed mean latent
                 :return: inpainted img with size  [b,c,h,w]
                 """
         # if infer imgs is None,  copy and get flipped batch
@@ -95,13 +101,15 @@ class EXE_GAN():
         gin = torch.cat((im_in, mask_01 - 0.5), 1)
         # generate noises
         noise = mixing_noise(real_imgs.shape[0], self.latent, self.mixing, self.device)
-        # embedding
-        infer_embeddings = self.psp_embedding(infer_imgs)
+        # embedding (deterministic, so callers sampling repeatedly can pass it in)
+        if infer_embeddings is None:
+            infer_embeddings = self.psp_embedding(infer_imgs)
 
-        trunc_latent = self.generator.mean_latent(4096,device=self.device)
+        if truncation_latent is None:
+            truncation_latent = self.generator.mean_latent(4096,device=self.device)
 
         # get fake
-        fake_img = self.generator(gin, infer_embeddings, noise, truncation_latent=trunc_latent,truncation=truncation)
+        fake_img = self.generator(gin, infer_embeddings, noise, truncation_latent=truncation_latent,truncation=truncation)
 
         # get completed
         completed_imgs = get_completion(fake_img, real_imgs.detach(), mask_01.detach())
@@ -1,36 +1,129 @@
 # service/api.py
+import asyncio
+import io
+
 from fastapi import FastAPI, File, UploadFile, Form
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
 from PIL import Image
-import io
 
-from .exegan_service import ExeGanGuidedRecovery
+from .exegan_service import MAX_BATCH, ExeGanGuidedRecovery, pil_to_ndarray_fast
+
+try:
+    import pyspng  # optional, faster PNG codec than Pillow/libpng
+
+except ImportError:
+    pyspng = None
 
 app = FastAPI()
 service = ExeGanGuidedRecovery()
 
+_PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+# Cap how many requests hold decoded pixel buffers in RAM at once. The
+# semaphore spans the whole handler body - decode, inference, encode - since
+# the decoded images stay alive that long; this keeps peak memory from
+# scaling with the number of concurrent uploads.
+MAX_INFLIGHT_REQUESTS = 8
+inflight_semaphore = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+
+
+def ensure_mode(img: Image.Image, mode: str) -> Image.Image:
+    """Convert only when needed; .convert on a matching mode still copies."""
+    if img.mode == mode:
+        return img
+    return img.convert(mode)
+
+
+def decode_upload(upload: UploadFile, mode: str) -> Image.Image:
+    """
+    Decode an upload straight from its spooled temp file.
+
+    Starlette spools uploads over 1 MB to disk, so reading from upload.file
+    avoids materializing every payload in RAM up front. pyspng is used for
+    PNG payloads when available, Pillow otherwise.
+    """
+    f = upload.file
+    f.seek(0)
+    if pyspng is not None and f.read(8) == _PNG_MAGIC:
+        f.seek(0)
+        return ensure_mode(Image.fromarray(pyspng.load(f.read())), mode)
+    f.seek(0)
+    img = Image.open(f)
+    img.load()  # force the decode here, on the worker thread
+    return ensure_mode(img, mode)
+
+
+def encode_png(img: Image.Image) -> bytes:
+    """Encode a PIL image to PNG bytes, preferring pyspng when it can encode."""
+    if pyspng is not None and hasattr(pyspng, "encode"):
+        return pyspng.encode(pil_to_ndarray_fast(img))
+    with io.BytesIO() as buf:
+        img.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def encode_outputs(outputs) -> list:
+    """Encode every generated sample (runs on a worker thread)."""
+    return [encode_png(img) for img in outputs]
+
+
+def multipart_pngs(pngs: list) -> Response:
+    """Pack several PNG payloads into one multipart/mixed response body."""
+    boundary = "exegan-sample"
+    body = bytearray()
+    for j, data in enumerate(pngs):
+        body += (
+            f"--{boundary}\r\n"
+            f"Content-Type: image/png\r\n"
+            f'Content-Disposition: attachment; filename="{j}_inpaint.png"\r\n'
+            f"\r\n"
+        ).encode()
+        body += data
+        body += b"\r\n"
+    body += f"--{boundary}--\r\n".encode()
+    return Response(
+        content=bytes(body),
+        media_type=f"multipart/mixed; boundary={boundary}",
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    service.start_batcher()
+    # Dummy forwards pay CUDA/cuDNN/compile warmup cost before real traffic
+    await run_in_threadpool(service._warmup)
+
+
 @app.post("/exegan/guided_recovery")
 async def guided_recovery(
     test_image: UploadFile = File(...),
     mask_image: UploadFile = File(...),
     exemplar_image: UploadFile = File(...),
-    sample_times: int = Form(1),
+    sample_times: int = Form(1, ge=1, le=MAX_BATCH),
 ):
-    # 1) Read uploaded files
-    test_bytes = await test_image.read()
-    mask_bytes = await mask_image.read()
-    ex_bytes   = await exemplar_image.read()
-
-    # 2) Convert to PIL (assume already 256x256 on client side)
-    test_img = Image.open(io.BytesIO(test_bytes)).convert("RGB")
-    mask_img = Image.open(io.BytesIO(mask_bytes)).convert("L")
-    ex_img   = Image.open(io.BytesIO(ex_bytes)).convert("RGB")
-
-    # 3) Run EXE-GAN
-    outputs = service.run(test_img, mask_img, ex_img, sample_times=sample_times)
-
-    # 4) Return first output as PNG
-    buf = io.BytesIO()
-    outputs[0].save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.getvalue(), media_type="image/png")
+    # The semaphore is held until the response bytes exist, because the
+    # decoded buffers live that long too.
+    async with inflight_semaphore:
+        # 1+2) Decode the three uploads in parallel on the threadpool (assume
+        #      already 256x256 on client side). PNG decode releases the GIL
+        #      in zlib/libpng, so the wait drops to the slowest of the three
+        #      instead of their sum.
+        test_img, mask_img, ex_img = await asyncio.gather(
+            run_in_threadpool(decode_upload, test_image, "RGB"),
+            run_in_threadpool(decode_upload, mask_image, "L"),
+            run_in_threadpool(decode_upload, exemplar_image, "RGB"),
+        )
+
+        # 3) Run EXE-GAN; concurrent requests are coalesced into one GPU batch
+        outputs = await service.run_async(
+            test_img, mask_img, ex_img, sample_times=sample_times
+        )
+
+        # 4) Encode off the event loop and hand the raw bytes to the response.
+        #    One sample -> plain image/png; several -> multipart, so the extra
+        #    generated samples are no longer thrown away.
+        pngs = await run_in_threadpool(encode_outputs, outputs)
+    if len(pngs) == 1:
+        return Response(content=pngs[0], media_type="image/png")
+    return multipart_pngs(pngs)
@@ -1,13 +1,58 @@
+import asyncio
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional
-import subprocess
 
+import numpy as np
+import torch
 from PIL import Image
 
+# guided_recovery.py and its imports (models, op, ...) live at the repo root.
+_REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(_REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(_REPO_ROOT))
+
+from guided_recovery import build_model, run_inference
+
+# Dynamic batching: coalesce requests that arrive within MAX_WAIT_MS into one
+# forward pass of at most MAX_BATCH samples.
+MAX_BATCH = 4
+MAX_WAIT_MS = 10
+
+
+def pil_to_ndarray_fast(img: Image.Image) -> np.ndarray:
+    """
+    PIL image -> uint8 ndarray through one raw-encoder call.
+
+    np.asarray(img) goes through Image.tobytes(), which encodes in many small
+    chunks and joins them in Python (~2x slower, 2x peak memory). Calling the
+    raw encoder once over the full image avoids that. Falls back to
+    np.asarray if the private encoder API ever changes.
+    """
+    try:
+        img.load()
+        channels = len(img.getbands())
+        encoder = Image._getencoder(img.mode, "raw", img.mode)
+        encoder.setimage(img.im)
+        _, status, data = encoder.encode(img.width * img.height * channels)
+        # status 1 = image complete; 0 = buffer exhausted first (data is
+        # partial), negative = error. Anything but 1 means fall back.
+        if status != 1:
+            raise OSError(f"raw encoder failed with status {status}")
+        arr = np.frombuffer(data, np.uint8)
+        if channels > 1:
+            return arr.reshape(img.height, img.width, channels)
+        return arr.reshape(img.height, img.width)
+    except (AttributeError, OSError, ValueError):
+        return np.asarray(img, dtype=np.uint8)
+
 
 class ExeGanGuidedRecovery:
     """
-    Wrapper around EXE-GAN's guided_recovery.py.
+    Wrapper around EXE-GAN's guided recovery.
 
     Cloud-side assumptions:
       * All inputs are already preprocessed locally.
@@ -15,14 +60,16 @@ class ExeGanGuidedRecovery:
       * No face detection / cropping / resizing is done here.
 
     Inputs (all PIL.Image.Image):
-      - test_img:      face image to be edited (goes to images/target)
-      - mask_img:      mask image (white = region to inpaint, goes to images/mask)
-      - exemplar_img:  guidance face image (goes to images/exemplar)
+      - test_img:      face image to be edited
+      - mask_img:      mask image (white = region to inpaint)
+      - exemplar_img:  guidance face image
 
     Behavior:
-      - Saves these 3 images into the folders EXE-GAN expects.
-      - Calls guided_recovery.py with those dirs.
-      - Loads generated images from recover_out and returns them as PIL images.
+      - Loads the pSp + EXE-GAN checkpoints once at construction and keeps the
+        model resident on GPU (no subprocess, no per-request torch.load).
+      - Converts the 3 inputs to tensors in memory, runs inference in process,
+        and returns the generated images as PIL images. Nothing touches disk
+        unless debug_dump=True.
     """
 
     def __init__(
@@ -31,6 +78,7 @@ class ExeGanGuidedRecovery:
         psp_ckpt_rel: str = "pre-train/psp_ffhq_encode.pt",
         exegan_ckpt_rel: str = "checkpoint/EXE_GAN_model.pt",
         sample_size: int = 256,
+        debug_dump: bool = False,
     ):
         """
         :param repo_root: Path to EXE-GAN repo root. If None, assumes this file is
@@ -38,6 +86,8 @@ class ExeGanGuidedRecovery:
         :param psp_ckpt_rel: Path to pSp checkpoint relative to repo_root.
         :param exegan_ckpt_rel: Path to EXE-GAN checkpoint relative to repo_root.
         :param sample_size: Image size EXE-GAN expects (default 256).
+        :param debug_dump: If True, also write inputs/outputs to disk like the
+                           old subprocess flow did (for inspection only).
         """
         if repo_root is None:
             # <repo_root>/service/exegan_service.py → parents[1] is repo_root
@@ -48,43 +98,60 @@ class ExeGanGuidedRecovery:
         self.psp_ckpt = self.repo_root / psp_ckpt_rel
         self.exegan_ckpt = self.repo_root / exegan_ckpt_rel
 
-        # New cleaned structure: images/mask, images/target, images/exemplar
-        self.mask_dir = self.repo_root / "images" / "mask"          # --masked_dir
-        self.gt_dir = self.repo_root / "images" / "target"          # --gt_dir
-        self.exemplar_dir = self.repo_root / "images" / "exemplar"  # --exemplar_dir
-        self.out_dir = self.repo_root / "recover_out"               # --eval_dir
+        # Debug dumps land in a unique per-request directory under here
+        self.debug_dir = self.repo_root / "debug_dump"
 
         self.sample_size = sample_size
+        self.device = "cuda"
+        self.debug_dump = debug_dump
 
-        for d in (self.mask_dir, self.gt_dir, self.exemplar_dir, self.out_dir):
-            d.mkdir(parents=True, exist_ok=True)
+        if debug_dump:
+            self.debug_dir.mkdir(parents=True, exist_ok=True)
 
-    # ---------------- internal helpers ---------------- #
+        # Build the model up front; the underlying checkpoint loads are cached
+        # per path, so further instances in the same process skip torch.load.
+        self._model = build_model(
+            str(self.psp_ckpt), str(self.exegan_ckpt), size=sample_size
+        )
 
-    def _clear_io_dirs(self) -> None:
-        """Remove old images from input/output dirs to avoid collisions."""
-        for d in (self.mask_dir, self.gt_dir, self.exemplar_dir, self.out_dir):
-            for f in d.iterdir():
-                if f.is_file():
-                    f.unlink()
+        # Pinned staging buffers, reused across requests: allocating
+        # page-locked memory per request is measurable at high QPS, and a
+        # dedicated copy stream lets H2D uploads overlap with compute from
+        # earlier requests. Guarded by a lock since run() may be called from
+        # several threads.
+        self._staging_lock = threading.Lock()
+        self._pinned_imgs = None
+        self._pinned_mask = None
+        self._copy_stream = None
+        if self.device == "cuda":
+            # uint8 HWC staging: row 0 = test image, row 1 = exemplar
+            self._pinned_imgs = torch.empty(
+                (2, sample_size, sample_size, 3), dtype=torch.uint8, pin_memory=True
+            )
+            self._pinned_mask = torch.empty(
+                (sample_size, sample_size), dtype=torch.uint8, pin_memory=True
+            )
+            self._copy_stream = torch.cuda.Stream()
+
+        # Separate pools for CPU-bound pre/postprocessing, so decode/normalize
+        # and tensor->PIL work never stalls the event loop or delays the next
+        # GPU batch.
+        self._pre_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="exegan-pre")
+        self._post_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="exegan-post")
 
-    def _save_triplet(
+        # Batching state; created lazily on the serving event loop.
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+
+    # ---------------- internal helpers ---------------- #
+
+    def _validate_sizes(
         self,
         test_img: Image.Image,
         mask_img: Image.Image,
         exemplar_img: Image.Image,
-        index: int = 0,
     ) -> None:
-        """
-        Save inputs to the correct folders with a consistent filename (<index>.png).
-
-        Mapping:
-          test_img     -> images/target    (image to edit)
-          mask_img     -> images/mask      (mask)
-          exemplar_img -> images/exemplar  (guidance)
-
-        Assumes all images are already (sample_size x sample_size).
-        """
+        """All inputs must already be (sample_size x sample_size)."""
         expected = (self.sample_size, self.sample_size)
 
         if test_img.size != expected:
@@ -103,49 +170,104 @@ class ExeGanGuidedRecovery:
                 "Do exemplar cropping/resizing on the client before calling EXE-GAN."
             )
 
-        # No resizing here – just save as-is
-        test_img.save(self.gt_dir / f"{index}.png")
-        mask_img.save(self.mask_dir / f"{index}.png")
-        exemplar_img.save(self.exemplar_dir / f"{index}.png")
-
-    def _run_script(self, sample_times: int = 1) -> None:
-        """Call guided_recovery.py with our image directories."""
-        cmd = [
-            "python",
-            "guided_recovery.py",
-            "--psp_checkpoint_path",
-            str(self.psp_ckpt),
-            "--ckpt",
-            str(self.exegan_ckpt),
-            "--masked_dir",
-            str(self.mask_dir),
-            "--gt_dir",
-            str(self.gt_dir),
-            "--exemplar_dir",
-            str(self.exemplar_dir),
-            "--sample_times",
-            str(sample_times),
-            "--eval_dir",
-            str(self.out_dir),
-        ]
-        subprocess.run(cmd, cwd=str(self.repo_root), check=True)
-
-    def _load_outputs(self, index: int = 0, sample_times: int = 1) -> List[Image.Image]:
+    def _img_to_tensor(self, img: Image.Image) -> "torch.Tensor":
+        """uint8 HWC PIL image -> [1,3,size,size] float tensor in [-1,1] on device."""
+        arr = pil_to_ndarray_fast(img)
+        tensor = torch.from_numpy(arr).permute(2, 0, 1).contiguous()
+        tensor = tensor.float().div_(127.5).sub_(1.0).unsqueeze(0)
+        if self.device == "cuda":
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
+
+    def _mask_to_tensor(self, mask_img: Image.Image) -> "torch.Tensor":
+        """L-mode PIL mask -> [1,1,size,size] binary tensor (masked pixel = 1)."""
+        arr = pil_to_ndarray_fast(mask_img)
+        # Same threshold as img_load_util.load_mask2tensor
+        mask = torch.from_numpy((arr > 200).astype(np.float32))
+        mask = mask.unsqueeze(0).unsqueeze(0)
+        if self.device == "cuda":
+            mask = mask.pin_memory()
+        return mask.to(self.device, non_blocking=True)
+
+    def _to_tensors(
+        self,
+        test_img: Image.Image,
+        mask_img: Image.Image,
+        exemplar_img: Image.Image,
+    ):
+        """
+        Convert the input triplet to device tensors without touching disk.
+
+        On CUDA the pixels go through the pre-allocated pinned staging buffers
+        and are uploaded on the dedicated copy stream; everything downstream
+        (normalize, mask threshold) runs on device.
+        """
+        if self._pinned_imgs is None:
+            return (
+                self._img_to_tensor(test_img),
+                self._mask_to_tensor(mask_img),
+                self._img_to_tensor(exemplar_img),
+            )
+
+        with self._staging_lock:
+            np.copyto(self._pinned_imgs[0].numpy(), pil_to_ndarray_fast(test_img))
+            np.copyto(self._pinned_imgs[1].numpy(), pil_to_ndarray_fast(exemplar_img))
+            np.copyto(self._pinned_mask.numpy(), pil_to_ndarray_fast(mask_img))
+
+            with torch.cuda.stream(self._copy_stream):
+                imgs = self._pinned_imgs.to(self.device, non_blocking=True)
+                mask_u8 = self._pinned_mask.to(self.device, non_blocking=True)
+                imgs = imgs.permute(0, 3, 1, 2).float().div_(127.5).sub_(1.0)
+                # Same threshold as img_load_util.load_mask2tensor
+                mask = (mask_u8 > 200).float().unsqueeze(0).unsqueeze(0)
+            # These tensors were allocated on the copy stream but are consumed
+            # and freed on the default stream; record_stream keeps the caching
+            # allocator from recycling their blocks for the next request's H2D
+            # copy while a forward pass is still reading them.
+            default_stream = torch.cuda.current_stream()
+            imgs.record_stream(default_stream)
+            mask.record_stream(default_stream)
+            # The staging buffers may only be reused (and the tensors consumed
+            # on other streams) once the copy stream has drained.
+            self._copy_stream.synchronize()
+
+        return imgs[0:1], mask, imgs[1:2]
+
+    def _tensors_to_pils(self, outs: List["torch.Tensor"]) -> List[Image.Image]:
+        """Postprocess a request's output tensors into PIL images."""
+        return [self._tensor_to_pil(t) for t in outs]
+
+    @staticmethod
+    def _tensor_to_pil(out: "torch.Tensor") -> Image.Image:
+        """[3,size,size] tensor in [-1,1] -> RGB PIL image."""
+        arr = (
+            out.mul(127.5).add(127.5).clamp(0, 255).byte()
+            .permute(1, 2, 0).cpu().numpy()
+        )
+        return Image.fromarray(arr)
+
+    def _dump_debug(
+        self,
+        test_img: Image.Image,
+        mask_img: Image.Image,
+        exemplar_img: Image.Image,
+        outputs: List[Image.Image],
+    ) -> None:
         """
-        EXE-GAN names outputs like: <name>_<jj>_inpaint.png.
+        Dump the request's inputs and outputs to a fresh directory under
+        debug_dump/. Each request gets its own mkdtemp directory, so
+        concurrent requests never collide and no cleanup scan is needed.
 
-        With our convention:
-          name = index
-        so outputs are: '0_0_inpaint.png', '0_1_inpaint.png', ...
+        Dumps are BMP: these files are only ever read back locally, so PNG's
+        DEFLATE pass would be wasted CPU. Only the HTTP response stays PNG.
         """
-        imgs: List[Image.Image] = []
-        for j in range(sample_times):
-            fname = f"{index}_{j}_inpaint.png"
-            path = self.out_dir / fname
-            if not path.exists():
-                raise FileNotFoundError(f"Missing EXE-GAN output: {path}")
-            imgs.append(Image.open(path).convert("RGB"))
-        return imgs
+        self.debug_dir.mkdir(parents=True, exist_ok=True)
+        dump_dir = Path(tempfile.mkdtemp(prefix="request_", dir=self.debug_dir))
+        test_img.save(dump_dir / "target.bmp")
+        mask_img.save(dump_dir / "mask.bmp")
+        exemplar_img.save(dump_dir / "exemplar.bmp")
+        for j, out in enumerate(outputs):
+            out.save(dump_dir / f"{j}_inpaint.bmp")
 
     # ---------------- public API ---------------- #
 
@@ -159,13 +281,159 @@ class ExeGanGuidedRecovery:
         """
         Main callable.
 
-        :param test_img:      PIL image, preprocessed face to be edited (→ images/target).
-        :param mask_img:      PIL image, preprocessed mask (→ images/mask).
-        :param exemplar_img:  PIL image, preprocessed guidance face (→ images/exemplar).
+        :param test_img:      PIL image, preprocessed face to be edited.
+        :param mask_img:      PIL image, preprocessed mask (white = inpaint).
+        :param exemplar_img:  PIL image, preprocessed guidance face.
         :param sample_times:  How many stochastic samples EXE-GAN should generate.
         :return: list of reconstructed images (length = sample_times).
         """
-        self._clear_io_dirs()
-        self._save_triplet(test_img, mask_img, exemplar_img, index=0)
-        self._run_script(sample_times=sample_times)
-        return self._load_outputs(index=0, sample_times=sample_times)
+        self._validate_sizes(test_img, mask_img, exemplar_img)
+        gt_tensor, mask_tensor, exemplar_tensor = self._to_tensors(
+            test_img, mask_img, exemplar_img
+        )
+        completed_imgs = run_inference(
+            self._model, gt_tensor, mask_tensor, exemplar_tensor, sample_times=sample_times
+        )
+        outputs = [self._tensor_to_pil(t[0]) for t in completed_imgs]
+        if self.debug_dump:
+            self._dump_debug(test_img, mask_img, exemplar_img, outputs)
+        return outputs
+
+    def _warmup(self) -> None:
+        """
+        Run dummy forwards so CUDA context init, cuDNN algo selection, the
+        allocator, and torch.compile all pay their one-time costs before the
+        first real request.
+
+        Every batch size the batcher can emit (1..MAX_BATCH, see _run_batch's
+        chunking) is warmed, since reduce-overhead mode recompiles per
+        distinct shape. torch.compile is lazy, so Inductor failures surface
+        here; in that case the generator is unwrapped back to eager and the
+        warmup is redone.
+        """
+        if self.device != "cuda" or not torch.cuda.is_available():
+            return
+        size = self.sample_size
+        for batch in range(1, MAX_BATCH + 1):
+            gt = torch.zeros((batch, 3, size, size), device=self.device)
+            mask = torch.zeros((batch, 1, size, size), device=self.device)
+            exemplar = torch.zeros((batch, 3, size, size), device=self.device)
+            try:
+                run_inference(self._model, gt, mask, exemplar, sample_times=1)
+            except Exception as e:
+                eager = getattr(self._model.generator, "_orig_mod", None)
+                if eager is None:
+                    raise
+                print("torch.compile failed during warmup, running eager:", e)
+                self._model.generator = eager
+                run_inference(self._model, gt, mask, exemplar, sample_times=1)
+        torch.cuda.synchronize()
+
+    # ---------------- dynamic batching ---------------- #
+
+    def start_batcher(self) -> None:
+        """Start the background batching task. Must run inside an event loop."""
+        if self._batch_task is None:
+            self._queue = asyncio.Queue()
+            self._batch_task = asyncio.get_event_loop().create_task(self._batch_worker())
+
+    def _run_batch(self, items) -> List[List["torch.Tensor"]]:
+        """
+        Stack the queued triplets into one forward pass.
+
+        sample_times > 1 is handled by repeating that request's tensors along
+        the batch axis; every batch row draws its own noise, so samples stay
+        stochastic. The stacked batch is forwarded in chunks of at most
+        MAX_BATCH samples, so GPU memory stays bounded no matter how many
+        samples the drained requests add up to. Returns, per request, a list
+        of [3,size,size] tensors.
+        """
+        gts, masks, exemplars, counts = [], [], [], []
+        for (gt, mask, exemplar), sample_times, _ in items:
+            gts.append(gt.expand(sample_times, -1, -1, -1))
+            masks.append(mask.expand(sample_times, -1, -1, -1))
+            exemplars.append(exemplar.expand(sample_times, -1, -1, -1))
+            counts.append(sample_times)
+
+        gt_b = torch.cat(gts)
+        mask_b = torch.cat(masks)
+        exemplar_b = torch.cat(exemplars)
+
+        chunks = []
+        for start in range(0, gt_b.shape[0], MAX_BATCH):
+            end = start + MAX_BATCH
+            chunks.append(
+                run_inference(
+                    self._model,
+                    gt_b[start:end],
+                    mask_b[start:end],
+                    exemplar_b[start:end],
+                    sample_times=1,
+                )[0]
+            )
+        completed = torch.cat(chunks) if len(chunks) > 1 else chunks[0]
+
+        results, start = [], 0
+        for n in counts:
+            results.append([completed[start + j] for j in range(n)])
+            start += n
+        return results
+
+    async def _batch_worker(self) -> None:
+        """Drain the queue: up to MAX_BATCH requests or MAX_WAIT_MS of waiting."""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            while sum(st for _, st, _ in items) < MAX_BATCH:
+                try:
+                    items.append(
+                        await asyncio.wait_for(self._queue.get(), MAX_WAIT_MS / 1000.0)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(None, self._run_batch, items)
+            except Exception as exc:  # propagate failures to every waiter
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            for (_, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def run_async(
+        self,
+        test_img: Image.Image,
+        mask_img: Image.Image,
+        exemplar_img: Image.Image,
+        sample_times: int = 1,
+    ) -> List[Image.Image]:
+        """
+        Batching-aware variant of run() for concurrent callers.
+
+        Enqueues the request and awaits its slice of the next batched forward
+        pass. Preprocessing and postprocessing run on their own thread pools,
+        so the event loop and the GPU batch worker are never stalled by
+        CPU-bound pixel work. Same inputs/outputs as run().
+        """
+        self._validate_sizes(test_img, mask_img, exemplar_img)
+        if self._queue is None:
+            self.start_batcher()
+
+        loop = asyncio.get_running_loop()
+        tensors = await loop.run_in_executor(
+            self._pre_pool, self._to_tensors, test_img, mask_img, exemplar_img
+        )
+        future = loop.create_future()
+        await self._queue.put((tensors, sample_times, future))
+        completed = await future
+
+        outputs = await loop.run_in_executor(
+            self._post_pool, self._tensors_to_pils, completed
+        )
+        if self.debug_dump:
+            self._dump_debug(test_img, mask_img, exemplar_img, outputs)
+        return outputs
@@ -1,9 +1,32 @@
 from pathlib import Path
+
+import cv2
 from PIL import Image
 
 from exegan_service import ExeGanGuidedRecovery
 
 
+def load_rgb(path, size):
+    """
+    Decode + resize through OpenCV's SIMD kernels instead of PIL's resample.
+
+    Returns an RGB PIL image of exactly `size` (w, h); images that are
+    already the right size skip the resize entirely.
+    """
+    arr = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if arr.shape[1::-1] != size:
+        arr = cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+    return Image.fromarray(cv2.cvtColor(arr, cv2.COLOR_BGR2RGB))
+
+
+def load_mask(path, size):
+    """Like load_rgb but grayscale, with NEAREST so the mask stays crisp."""
+    arr = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    if arr.shape[1::-1] != size:
+        arr = cv2.resize(arr, size, interpolation=cv2.INTER_NEAREST)
+    return Image.fromarray(arr)
+
+
 def main():
     # repo_root = EXE-GAN folder
     repo_root = Path(__file__).resolve().parents[1]
@@ -23,10 +46,9 @@ def main():
     # EXE-GAN expects 256x256, so for this local test we enforce it here
     size = (256, 256)
 
-    test_img = Image.open(test_path).convert("RGB").resize(size)
-    # Mask should be single-channel (L); keep NEAREST if you want it crisp
-    mask_img = Image.open(mask_path).convert("L").resize(size)
-    ex_img   = Image.open(ex_path).convert("RGB").resize(size)
+    test_img = load_rgb(test_path, size)
+    mask_img = load_mask(mask_path, size)
+    ex_img   = load_rgb(ex_path, size)
 
     service = ExeGanGuidedRecovery(repo_root=repo_root)
 